@@ -1,15 +1,20 @@
 #!/usr/bin/env python
 import argparse
-import distutils.version
+import binascii
 import errno
-import io
+import httplib
 import logging
+import multiprocessing.pool
 import os
 import re
 import shutil
+import stat
 import sys
 import tempfile
+import threading
+import urllib
 import urllib2
+import urlparse
 import zipfile
 
 try:
@@ -18,17 +23,30 @@ except ImportError:
     import ConfigParser as configparser
 
 
+SDK_FILENAME = 'google_appengine_%s.zip'
 SDK_DOWNLOAD_URL = 'https://storage.googleapis.com/appengine-sdks/featured/google_appengine_%s.zip'
 SDK_OLD_DOWNLOAD_URL = 'https://storage.googleapis.com/appengine-sdks/deprecated/%s/google_appengine_%s.zip'
 CONFIG_FILENAME = 'sdkswitcher.ini'
 SDK_VERSION_LATEST = 'latest'
-SDK_VERSION_PATTERN = re.compile(r'^\d+\.\d+\.\d+$') # Like '1.9.57'
+SDK_VERSION_PATTERN = re.compile(r'^\d+\.\d+\.\d+\Z') # Like '1.9.57'
 SDK_VERSION_CHECK_URL = 'https://appengine.google.com/api/updatecheck'
+SDK_RELEASE_PATTERN = re.compile(r'\brelease: "([^"]+)"') # In the update check response
+UNSAFE_FILENAME_PATTERN = re.compile(r'[^-_a-zA-Z0-9]+')
 UTF8 = 'utf-8'
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+EXTRACT_TIMEOUT = 24 * 60 * 60 # Seconds, long enough for any SDK archive.
+DELETING_MARKER = '.deleting.' # In the name of an SDK directory being removed.
+DELETING_PATTERN = re.compile(r'^\d+\.\d+\.\d+\.deleting\.[0-9a-f]{8}\Z') # Like '1.9.57.deleting.0a1b2c3d'
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
 
 
 logger = logging.getLogger(__name__)
 
+# Open HTTP connections, keyed by (scheme, host), so that successive requests
+# to the same server re-use the connection.
+_connections = {}
+
 
 class BadVersionString(ValueError):
     """The version was not valid."""
@@ -86,6 +104,11 @@ class Env(object):
             config = self.default_config()
 
         self.config = config
+        # The sorted list of installed SDK versions, or None if not yet read.
+        self._installed_versions = None
+        # Expanded paths from the config, or None if not yet worked out.
+        self._cache_dir = None
+        self._sdk_link = None
 
     @classmethod
     def load(cls):
@@ -128,6 +151,9 @@ class Env(object):
 
     def cache_dir(self):
         """The full directory to store cached SDKs."""
+        if self._cache_dir is not None:
+            return self._cache_dir
+
         cache_dir = self.config.defaults()['cache_dir']
 
         if not cache_dir:
@@ -135,11 +161,15 @@ class Env(object):
 
         cache_dir = os.path.expanduser(cache_dir)
         cache_dir = os.path.abspath(cache_dir)
+        self._cache_dir = cache_dir
 
         return cache_dir
 
     def sdk_link(self):
         """The currently configured location for the full SDK symlink."""
+        if self._sdk_link is not None:
+            return self._sdk_link
+
         link = self.config.defaults()['link']
 
         if link:
@@ -148,6 +178,8 @@ class Env(object):
             link = os.path.join(link, 'google_appengine')
             link = os.path.abspath(link)
 
+        self._sdk_link = link
+
         return link
 
     def save_config(self):
@@ -168,16 +200,27 @@ class Env(object):
         link = self.sdk_link()
         cache_dir = self.cache_dir()
         target = os.path.join(cache_dir, version, 'google_appengine')
+        # Make the new link alongside the old one, then rename it over the top.
+        # The rename replaces the old link in one step, so there is never a
+        # moment without a link.
+        new_link = link + '.new'
+
         try:
-            os.symlink(target, link)
+            os.symlink(target, new_link)
         except OSError as err:
             if err.errno == errno.EEXIST:
-                # (17, 'File exists'):
-                os.unlink(link)
-                os.symlink(target, link)
+                # (17, 'File exists') Left over from an earlier attempt.
+                os.unlink(new_link)
+                os.symlink(target, new_link)
             else:
                 raise
 
+        try:
+            os.rename(new_link, link)
+        except OSError:
+            os.unlink(new_link)
+            raise
+
         return target
 
     def active_version(self):
@@ -208,14 +251,13 @@ class Env(object):
         return version
 
     def _check(self):
-        pattern = re.compile(r'\brelease: "([^"]+)"')
-        response = urllib2.urlopen(SDK_VERSION_CHECK_URL)
-
-        for line in response:
-            match = pattern.search(line)
+        response = urlopen(SDK_VERSION_CHECK_URL)
+        # The response is small, search all of it at once. Reading it all also
+        # means the connection can be used again.
+        match = SDK_RELEASE_PATTERN.search(response.read())
 
-            if match:
-                return match.group(1)
+        if match:
+            return match.group(1)
 
     def download(self, version):
         version = self._resolve_version(version)
@@ -227,19 +269,17 @@ class Env(object):
         return filename
 
     def _download(self, version):
-        url = self._sdk_url(version)
-        try:
-            response = urllib2.urlopen(url)
-        except urllib2.HTTPError:
-            # Didn't work, maybe it's an old deprecated SDK?
-            url = self._sdk_url_deprecated(version)
-            response = urllib2.urlopen(url)
+        url = self._sdk_url_resolve(version)
+        response = urlopen(url)
 
-        suffix = safe_filename(url)
-        _, filename = tempfile.mkstemp(suffix=suffix)
+        # _resolve_version only returns versions that match SDK_VERSION_PATTERN,
+        # so the name is already safe.
+        suffix = SDK_FILENAME % (version,)
+        fd, filename = tempfile.mkstemp(suffix=suffix)
 
-        with open(filename, 'wb') as fh:
-            fh.write(response.read())
+        with os.fdopen(fd, 'wb') as fh:
+            # Copy in blocks so the whole archive is never held in memory.
+            shutil.copyfileobj(response, fh, DOWNLOAD_BLOCK_SIZE)
 
         return filename
 
@@ -253,6 +293,25 @@ class Env(object):
 
         return SDK_OLD_DOWNLOAD_URL % (version_no_dots, version)
 
+    @classmethod
+    def _sdk_url_resolve(cls, version):
+        """Returns the download URL for an SDK version.
+
+        A HEAD request checks the featured bucket first, so the archive itself
+        is only requested once.
+        """
+        url = cls._sdk_url(version)
+
+        try:
+            response = urlopen(url, method='HEAD')
+            # Finish with the response so the connection can be used again.
+            response.read()
+        except urllib2.HTTPError:
+            # Didn't work, maybe it's an old deprecated SDK?
+            url = cls._sdk_url_deprecated(version)
+
+        return url
+
     def install(self, version):
         """Install an SDK version.
 
@@ -267,8 +326,17 @@ class Env(object):
 
         if version not in installed_versions:
             sys.stdout.write('Downloading...\n')
+            self._remove_leftovers()
             filename = self._download(version)
-            self._extract(filename, version)
+
+            try:
+                self._extract(filename, version)
+            finally:
+                # The archive isn't needed after extracting, don't leave it
+                # taking up space in the temp directory.
+                os.unlink(filename)
+
+            self._installed_versions = None
 
             sys.stdout.write('Extracted SDK version %s\n' % version)
 
@@ -278,23 +346,25 @@ class Env(object):
         target = self.cache_dir()
         target = os.path.join(target, version)
 
-        with zipfile.ZipFile(filename, 'r') as archive:
-            archive.extractall(target)
+        members = extract_archive(filename, target)
 
         # Now set the SDK scripts as executable.
         target_sdk = os.path.join(target, 'google_appengine')
 
-        for root, dirs, files in os.walk(target_sdk):
-            for f in files:
-                if f.endswith('.py'):
-                    f = os.path.join(root, f)
-                    mode = os.stat(f).st_mode
-                    # Add execute bit for owner, group, others.
-                    mode = mode | 0o111
-                    os.chmod(f, mode)
+        # zipfile ignores the permissions stored in the archive, so every file
+        # it extracts is created with the default mode less the umask. Knowing
+        # that saves a stat call per script. There's no way to read the umask
+        # without setting it.
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+
+        for member in members:
+            dname, _, fname = member.filename.partition('/')
 
             # Only top-level scripts.
-            break
+            if dname == 'google_appengine' and fname.endswith('.py') and '/' not in fname:
+                make_executable(os.path.join(target_sdk, fname), mode=mode)
 
         return target
 
@@ -310,6 +380,7 @@ class Env(object):
         # Then we can clean up the old one.
 
         self.config.set(configparser.DEFAULTSECT, 'link', dest)
+        self._sdk_link = None
 
         new_link = self.sdk_link()
 
@@ -335,62 +406,105 @@ class Env(object):
         cache_dir = self.cache_dir()
         target = os.path.join(cache_dir, version)
 
-        shutil.rmtree(target)
+        self._remove_leftovers()
+
+        # Move the SDK out of the way first, so it is never half-deleted under
+        # its version name. If deleting is interrupted, the leftover directory
+        # is cleaned up by the next install or remove.
+        suffix = binascii.hexlify(os.urandom(4))
+        deleting = '%s%s%s' % (target, DELETING_MARKER, suffix)
+        os.rename(target, deleting)
+        self._installed_versions = None
+
+        shutil.rmtree(deleting)
 
         return target
 
+    def _remove_leftovers(self):
+        """Deletes SDK directories left behind by an interrupted remove."""
+        cache_dir = self.cache_dir()
+
+        try:
+            names = os.listdir(cache_dir)
+        except OSError as err:
+            if err.errno == errno.ENOENT:
+                # (2, 'No such file or directory') Nothing installed yet.
+                return
+            else:
+                raise
+
+        for name in names:
+            # Only the names made by _remove, in case the cache directory is
+            # shared with other things.
+            path = os.path.join(cache_dir, name)
+
+            if DELETING_PATTERN.match(name) and os.path.isdir(path):
+                shutil.rmtree(path)
+
     def summary(self):
         """List the installed SDK versions and indicate which is active."""
-        value = self._summary()
-        value = value.encode(UTF8)
-        sys.stdout.write(value)
-        sys.stdout.write('\n')
+        write = sys.stdout.write
+
+        for line in self._summary():
+            write(line.encode(UTF8))
 
-        return value
+        write('\n')
 
     def _summary(self):
-        """Returns summary as a string."""
+        """Yields the lines of the summary as unicode strings."""
         installed_versions = self._get_installed_versions()
         config_filename = self.config_filename()
         cache_dir = self.cache_dir()
         active = self.active_version()
         link = self.sdk_link()
 
-        out = io.StringIO()
-
-        out.write(u'Reading preferences from {}\n'.format(config_filename))
-        out.write(u'{} SDKs in {}\n'.format(len(installed_versions), cache_dir))
-        out.write(u'SDK symlink is {}\n'.format(link))
-        out.write(u'\n')
+        yield u'Reading preferences from {}\n'.format(config_filename)
+        yield u'{} SDKs in {}\n'.format(len(installed_versions), cache_dir)
+        yield u'SDK symlink is {}\n'.format(link)
+        yield u'\n'
 
         for version in installed_versions:
             flag = u' *' if version == active else u''
 
-            out.write(u'{:>10}{}\n'.format(version, flag))
-
-        value = out.getvalue()
-
-        return value
+            yield u'{:>10}{}\n'.format(version, flag)
 
     def _get_installed_versions(self):
         """Returns a list of SDK version strings.
 
-        The versions are sorted so that 1.9.5 is before 1.9.40.
+        The versions are sorted so that 1.9.5 is before 1.9.40. The list is
+        cached until an SDK is installed or removed.
         """
+        if self._installed_versions is not None:
+            return self._installed_versions
+
         cache_dir = self.cache_dir()
 
+        try:
+            names = os.listdir(cache_dir)
+        except OSError as err:
+            if err.errno == errno.ENOENT:
+                # (2, 'No such file or directory') Nothing installed yet.
+                names = []
+            else:
+                raise
+
         versions = []
 
-        for root, dirs, files in os.walk(cache_dir):
-            for d in dirs:
-                sdk_path = os.path.join(root, d, 'google_appengine')
+        for name in names:
+            # Skip anything that isn't named for a version, such as an SDK that
+            # is being deleted.
+            if not SDK_VERSION_PATTERN.match(name):
+                continue
 
-                if os.path.exists(sdk_path):
-                    versions.append(d)
+            # A version directory always contains a 'google_appengine'
+            # directory, so checking for that is enough.
+            sdk_path = os.path.join(cache_dir, name, 'google_appengine')
 
-            break
+            if os.path.isdir(sdk_path):
+                versions.append(name)
 
-        versions.sort(key=distutils.version.LooseVersion)
+        versions.sort(key=version_key)
+        self._installed_versions = versions
 
         return versions
 
@@ -398,7 +512,7 @@ class Env(object):
         """Returns an SDK version after resolving ambiguous values.
 
         For 'latest', this will hit the network to check the latest published
-        SDK version.
+        SDK version. The server's answer must look like a version string too.
 
         For a short version like '57', this will check if there is an installed
         SDK version that matches.
@@ -407,7 +521,13 @@ class Env(object):
         it matches more than 1 installed SDK.
         """
         if version == SDK_VERSION_LATEST:
-            return self._check()
+            version = self._check()
+
+            # It's used for file and directory names, so don't trust it.
+            if version is None or not SDK_VERSION_PATTERN.match(version):
+                raise BadVersionString
+
+            return version
 
         # It's something like '1.9.57'.
         if SDK_VERSION_PATTERN.match(version):
@@ -435,8 +555,8 @@ def safe_filename(url):
     """
     url = url.strip('/')
     _, _, filename = url.rpartition('/')
-    filename = re.sub(r'[^-_.a-zA-Z0-9]+', '.', filename)
-    filename = re.sub(r'\.+', '.', filename)
+    # Runs of dots and unsafe characters become a single dot.
+    filename = UNSAFE_FILENAME_PATTERN.sub('.', filename)
     filename = filename.strip('.')
 
     # If we've stripped everything out, fail.
@@ -446,6 +566,168 @@ def safe_filename(url):
     return filename
 
 
+def extract_archive(filename, target):
+    """Extracts all members of a zip archive to the target directory. Returns
+    the list of ZipInfo members.
+
+    The members are shared between a pool of threads. Decompressing and writing
+    files both release the GIL, so the threads do run in parallel.
+    """
+    with zipfile.ZipFile(filename, 'r') as archive:
+        members = archive.infolist()
+
+    try:
+        num_threads = multiprocessing.cpu_count()
+    except NotImplementedError:
+        num_threads = 1
+
+    num_threads = min(num_threads, len(members)) or 1
+    chunks = [members[i::num_threads] for i in range(num_threads)]
+
+    # Set to make the threads give up, e.g. after Ctrl-C.
+    stopping = threading.Event()
+
+    def extract_chunk(chunk):
+        # A ZipFile has a single file position, so each thread opens its own.
+        with zipfile.ZipFile(filename, 'r') as archive:
+            for member in chunk:
+                if stopping.is_set():
+                    return
+
+                try:
+                    archive.extract(member, target)
+                except OSError as err:
+                    if err.errno == errno.EEXIST:
+                        # (17, 'File exists') Another thread created the same
+                        # directory first. Now it exists, so try again.
+                        archive.extract(member, target)
+                    else:
+                        raise
+
+    pool = multiprocessing.pool.ThreadPool(num_threads)
+
+    try:
+        # On Python 2.7 waiting without a timeout holds back KeyboardInterrupt
+        # until every member has been extracted.
+        pool.map_async(extract_chunk, chunks).get(EXTRACT_TIMEOUT)
+    except BaseException:
+        stopping.set()
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+        pool.join()
+
+    return members
+
+
+def make_executable(filename, mode=None):
+    """Adds the execute bit for owner, group and others to a regular file.
+
+    If the permissions for the file are already known they can be passed as
+    mode. Otherwise the file is checked with os.stat().
+    """
+    if mode is None:
+        mode = os.stat(filename).st_mode
+
+        if not stat.S_ISREG(mode):
+            return
+
+    os.chmod(filename, mode | 0o111)
+
+
+def version_key(version):
+    """Returns a key for sorting version strings.
+
+    Numeric parts are compared as integers, so 1.9.5 is before 1.9.40.
+
+    >>> version_key('1.9.57')
+    (1, 9, 57)
+    """
+    return tuple(int(part) if part.isdigit() else part for part in version.split('.'))
+
+
+def urlopen(url, method='GET'):
+    """Returns the response for a request to the URL.
+
+    Connections are kept open and re-used for later requests to the same host,
+    which saves a TCP and TLS handshake per request. Redirects are followed. If
+    a proxy is configured in the environment the request goes through urllib2
+    instead, which knows how to use it.
+
+    Raises urllib2.HTTPError if the final response status is not 200, or
+    urllib2.URLError if the server can't be reached.
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlparse.urlsplit(url)
+
+        if parts.scheme in urllib.getproxies() and not urllib.proxy_bypass(parts.hostname):
+            return _urlopen_proxy(url, method)
+
+        response = _request(parts, method)
+
+        if response.status in REDIRECT_STATUSES:
+            location = response.getheader('location')
+            # Read the body so the connection can be used again.
+            response.read()
+
+            if location:
+                url = urlparse.urljoin(url, location)
+                continue
+
+        if response.status != 200:
+            # Read the error body so the connection can be used again.
+            response.read()
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+
+        return response
+
+    raise urllib2.HTTPError(url, response.status, 'Too many redirects', response.msg, None)
+
+
+def _request(parts, method):
+    """Sends a request on the pooled connection for the host, returns the
+    response.
+    """
+    key = (parts.scheme, parts.netloc)
+    path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+
+    conn = _connections.get(key)
+
+    if conn is None:
+        if parts.scheme == 'https':
+            conn = httplib.HTTPSConnection(parts.netloc)
+        else:
+            conn = httplib.HTTPConnection(parts.netloc)
+
+        _connections[key] = conn
+
+    try:
+        conn.request(method, path)
+        return conn.getresponse()
+    except (httplib.HTTPException, IOError):
+        # The server may have closed an idle connection. Try once more on a
+        # new connection.
+        conn.close()
+
+    try:
+        conn.request(method, path)
+        return conn.getresponse()
+    except (httplib.HTTPException, IOError) as err:
+        conn.close()
+        raise urllib2.URLError(err)
+
+
+def _urlopen_proxy(url, method):
+    """Returns the response for a request made with urllib2, which uses the
+    proxy settings from the environment.
+    """
+    request = urllib2.Request(url)
+    request.get_method = lambda: method
+
+    return urllib2.urlopen(request)
+
+
 def main():
     env = Env.load()
     parser = make_parser(env)
@@ -1,11 +1,14 @@
 import ConfigParser as configparser
 import errno
+import httplib
 import io
 import os
 import shutil
+import socket
 import tempfile
 import unittest
 import urllib2
+import zipfile
 
 import mock
 
@@ -156,6 +159,17 @@ class EnvTestCase(unittest.TestCase):
 
         self.assertEqual(result, '/home/foo/google_appengine')
 
+    @mock.patch.dict('os.environ', {'HOME': '/home/foo'})
+    def test_sdk_link_changes_with_link_command(self):
+        env = sdk.Env()
+        old_link = env.sdk_link()
+
+        with mock.patch.object(env, 'save_config'):
+            env.link('/bar/baz')
+
+        self.assertEqual(old_link, '/home/foo/google_appengine')
+        self.assertEqual(env.sdk_link(), '/bar/baz/google_appengine')
+
     @mock.patch('sys.platform', 'linux')
     def test_load_env_reads_preferences_from_home_dir(self):
         # We'll use a new temporary directory as the current user's $HOME.
@@ -251,11 +265,10 @@ class SummaryCommandTestCase(unittest.TestCase):
             '100.0.0',
             '1.0.0',
         ]
-        path_walk = [('/foo', versions, [])]
 
         with mock.patch('sys.stdout', new=io.BytesIO()) as m:
-            with mock.patch('os.walk', return_value=path_walk):
-                with mock.patch('os.path.exists', return_value=True):
+            with mock.patch('os.listdir', return_value=versions):
+                with mock.patch('os.path.isdir', return_value=True):
                     env.summary()
 
         self.assertEqual(
@@ -271,6 +284,51 @@ class SummaryCommandTestCase(unittest.TestCase):
         )
 
 
+class InstalledVersionsTestCase(unittest.TestCase):
+    @mock.patch('sys.platform', 'linux')
+    @mock.patch.dict('os.environ', {'HOME': '/home/foo'})
+    def test_installed_versions_are_cached(self):
+        env = sdk.Env()
+
+        with mock.patch('os.listdir', return_value=['1.9.57']) as mock_listdir:
+            with mock.patch('os.path.isdir', return_value=True):
+                env._get_installed_versions()
+                result = env._get_installed_versions()
+
+        self.assertEqual(result, ['1.9.57'])
+        self.assertEqual(mock_listdir.call_count, 1)
+
+    def test_installed_versions_ignores_directories_without_sdk(self):
+        temp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(temp_dir, '1.9.57', 'google_appengine'))
+        os.makedirs(os.path.join(temp_dir, '1.9.58'))
+        os.makedirs(os.path.join(temp_dir, '1.9.56.deleting.00010203', 'google_appengine'))
+        open(os.path.join(temp_dir, 'sdkswitcher.ini'), 'w').close()
+
+        config = configparser.ConfigParser(defaults={'cache_dir': temp_dir})
+        env = sdk.Env(config=config)
+
+        try:
+            result = env._get_installed_versions()
+        finally:
+            shutil.rmtree(temp_dir)
+
+        self.assertEqual(result, ['1.9.57'])
+
+    @mock.patch('sys.platform', 'linux')
+    @mock.patch.dict('os.environ', {'HOME': '/home/foo'})
+    def test_remove_clears_cached_versions(self):
+        env = sdk.Env()
+        env._installed_versions = ['1.9.57']
+
+        with mock.patch('os.listdir', return_value=[]):
+            with mock.patch('os.rename'):
+                with mock.patch('shutil.rmtree'):
+                    env._remove('1.9.57')
+
+        self.assertIsNone(env._installed_versions)
+
+
 class CheckCommandTestCase(unittest.TestCase):
     def test_can_parse_api_response(self):
         env = sdk.Env()
@@ -289,11 +347,38 @@ class CheckCommandTestCase(unittest.TestCase):
             "    api_versions: ['1.0']\n"
         )
 
-        with mock.patch('urllib2.urlopen', return_value=response):
+        with mock.patch('sdk.urlopen', return_value=response):
             result = env.check()
 
         self.assertEqual(result, '1.9.57')
 
+    def test_returns_none_if_api_response_has_no_release(self):
+        env = sdk.Env()
+        response = io.BytesIO("timestamp: 1516312066\n")
+
+        with mock.patch('sdk.urlopen', return_value=response):
+            result = env._check()
+
+        self.assertIsNone(result)
+
+
+class ResolveVersionTestCase(unittest.TestCase):
+    def test_latest_version_is_checked(self):
+        env = sdk.Env()
+
+        with mock.patch.object(env, '_check', return_value='1.9.57'):
+            result = env._resolve_version('latest')
+
+        self.assertEqual(result, '1.9.57')
+
+    def test_latest_version_must_be_a_version_string(self):
+        env = sdk.Env()
+
+        for value in ['../../etc/foo', '1.9.57/..', '1.9.57\n', '', None]:
+            with mock.patch.object(env, '_check', return_value=value):
+                with self.assertRaises(sdk.BadVersionString):
+                    env._resolve_version('latest')
+
 
 class ActivateCommandTestCase(unittest.TestCase):
     def test_can_activate_installed_sdk_version(self):
@@ -317,12 +402,32 @@ class ActivateCommandTestCase(unittest.TestCase):
             shutil.rmtree(temp_dir)
 
 
+    def test_activate_replaces_existing_link(self):
+        temp_dir = tempfile.mkdtemp()
+        env = sdk.Env()
+
+        try:
+            with mock.patch.dict('os.environ', {'HOME': temp_dir}):
+                with mock.patch('sys.platform', 'linux'):
+                    env.activate(version='1.9.57')
+                    env.activate(version='1.9.58')
+
+            link_filename = os.path.join(temp_dir, 'google_appengine')
+            link_target = os.readlink(link_filename)
+            expected = os.path.join(temp_dir, '.sdkswitcher', '1.9.58', 'google_appengine')
+            self.assertEqual(link_target, expected)
+            self.assertEqual(os.listdir(temp_dir), ['google_appengine'])
+
+        finally:
+            shutil.rmtree(temp_dir)
+
+
 class DownloadCommandTestCase(unittest.TestCase):
     def test_downloads_sdk_to_disk(self):
         env = sdk.Env()
         response = io.BytesIO('foo')
 
-        with mock.patch('urllib2.urlopen', return_value=response):
+        with mock.patch('sdk.urlopen', return_value=response):
             filename = env.download(version='1.9.57')
             # Clean up this temp file.
             os.unlink(filename)
@@ -335,14 +440,14 @@ class DownloadCommandTestCase(unittest.TestCase):
         env = sdk.Env()
         response = io.BytesIO('foo')
 
-        # First request gets a 404, which should cause a second request to the
-        # deprecated SDKs bucket.
+        # The HEAD request gets a 404, which should cause the download request
+        # to go to the deprecated SDKs bucket.
         side_effects = [
             urllib2.HTTPError('https://example.com/', 404, 'no', {}, None),
             response,
         ]
 
-        with mock.patch('urllib2.urlopen', side_effect=side_effects):
+        with mock.patch('sdk.urlopen', side_effect=side_effects) as mock_urlopen:
             filename = env.download(version='1.8.0')
             # Clean up this temp file.
             os.unlink(filename)
@@ -350,6 +455,243 @@ class DownloadCommandTestCase(unittest.TestCase):
         basename = os.path.basename(filename)
 
         self.assertTrue(basename.endswith('google_appengine_1.8.0.zip'), filename)
+        self.assertEqual(
+            mock_urlopen.call_args_list,
+            [
+                mock.call(sdk.SDK_DOWNLOAD_URL % '1.8.0', method='HEAD'),
+                mock.call(sdk.SDK_OLD_DOWNLOAD_URL % ('180', '1.8.0')),
+            ],
+        )
+
+
+class InstallCommandTestCase(unittest.TestCase):
+    def test_install_deletes_downloaded_archive(self):
+        temp_dir = tempfile.mkdtemp()
+        filename = os.path.join(temp_dir, 'google_appengine_1.9.57.zip')
+        open(filename, 'wb').close()
+
+        config = configparser.ConfigParser(defaults={'cache_dir': temp_dir})
+        env = sdk.Env(config=config)
+
+        try:
+            with mock.patch.object(env, '_download', return_value=filename):
+                with mock.patch.object(env, '_extract') as mock_extract:
+                    with mock.patch.object(env, 'activate'):
+                        env.install(version='1.9.57')
+
+            archive_exists = os.path.exists(filename)
+
+        finally:
+            shutil.rmtree(temp_dir)
+
+        self.assertEqual(mock_extract.call_args_list, [mock.call(filename, '1.9.57')])
+        self.assertFalse(archive_exists)
+
+    def test_install_activates_installed_sdk_without_cleaning_up(self):
+        env = sdk.Env()
+
+        with mock.patch.object(env, '_get_installed_versions', return_value=['1.9.57']):
+            with mock.patch.object(env, '_remove_leftovers') as mock_remove_leftovers:
+                with mock.patch.object(env, '_download') as mock_download:
+                    with mock.patch.object(env, 'activate') as mock_activate:
+                        env.install(version='1.9.57')
+
+        self.assertFalse(mock_remove_leftovers.called)
+        self.assertFalse(mock_download.called)
+        self.assertEqual(mock_activate.call_args_list, [mock.call('1.9.57')])
+
+
+class ExtractTestCase(unittest.TestCase):
+    def test_extract_sdk_archive(self):
+        temp_dir = tempfile.mkdtemp()
+        filename = os.path.join(temp_dir, 'google_appengine_1.9.57.zip')
+
+        with zipfile.ZipFile(filename, 'w') as archive:
+            archive.writestr('google_appengine/dev_appserver.py', 'foo')
+            archive.writestr('google_appengine/README', 'bar')
+            archive.writestr('google_appengine/lib/baz.py', 'baz')
+
+        config = configparser.ConfigParser(defaults={'cache_dir': temp_dir})
+        env = sdk.Env(config=config)
+
+        try:
+            target = env._extract(filename, '1.9.57')
+            target_sdk = os.path.join(target, 'google_appengine')
+
+            with open(os.path.join(target_sdk, 'lib', 'baz.py')) as fh:
+                contents = fh.read()
+
+            script_executable = os.access(os.path.join(target_sdk, 'dev_appserver.py'), os.X_OK)
+            readme_executable = os.access(os.path.join(target_sdk, 'README'), os.X_OK)
+            lib_executable = os.access(os.path.join(target_sdk, 'lib', 'baz.py'), os.X_OK)
+
+        finally:
+            shutil.rmtree(temp_dir)
+
+        self.assertEqual(target, os.path.join(temp_dir, '1.9.57'))
+        self.assertEqual(contents, 'baz')
+        # Only top-level scripts are made executable.
+        self.assertTrue(script_executable)
+        self.assertFalse(readme_executable)
+        self.assertFalse(lib_executable)
+
+
+    def test_extract_with_several_threads(self):
+        # Threads share nested directories, so they race to create them.
+        temp_dir = tempfile.mkdtemp()
+        filename = os.path.join(temp_dir, 'google_appengine_1.9.57.zip')
+        names = [
+            'google_appengine/lib/%d/%d/%d.py' % (i % 3, i % 5, i)
+            for i in range(200)
+        ]
+
+        with zipfile.ZipFile(filename, 'w') as archive:
+            for name in names:
+                archive.writestr(name, name)
+
+        target = os.path.join(temp_dir, 'out')
+
+        try:
+            with mock.patch('multiprocessing.cpu_count', return_value=8):
+                with mock.patch('multiprocessing.pool.ThreadPool', wraps=sdk.multiprocessing.pool.ThreadPool) as mock_pool:
+                    sdk.extract_archive(filename, target)
+
+            contents = []
+
+            for name in names:
+                with open(os.path.join(target, name)) as fh:
+                    contents.append(fh.read())
+
+        finally:
+            shutil.rmtree(temp_dir)
+
+        self.assertEqual(mock_pool.call_args_list, [mock.call(8)])
+        self.assertEqual(contents, names)
+
+    def test_extract_retries_member_if_directory_already_exists(self):
+        temp_dir = tempfile.mkdtemp()
+        filename = os.path.join(temp_dir, 'google_appengine_1.9.57.zip')
+
+        with zipfile.ZipFile(filename, 'w') as archive:
+            archive.writestr('google_appengine/lib/a.py', 'a')
+
+        target = os.path.join(temp_dir, 'out')
+        real_extract = zipfile.ZipFile.extract
+        file_exists = OSError(errno.EEXIST, 'File exists')
+
+        try:
+            with mock.patch.object(zipfile.ZipFile, 'extract', autospec=True) as mock_extract:
+                # The first call fails as if another thread made the directory,
+                # the retry goes to the real method.
+                def extract(archive, member, path):
+                    if mock_extract.call_count == 1:
+                        raise file_exists
+
+                    return real_extract(archive, member, path)
+
+                mock_extract.side_effect = extract
+                sdk.extract_archive(filename, target)
+
+            with open(os.path.join(target, 'google_appengine', 'lib', 'a.py')) as fh:
+                contents = fh.read()
+
+        finally:
+            shutil.rmtree(temp_dir)
+
+        self.assertEqual(mock_extract.call_count, 2)
+        self.assertEqual(contents, 'a')
+
+    def test_extract_stops_pool_on_keyboard_interrupt(self):
+        temp_dir = tempfile.mkdtemp()
+        filename = os.path.join(temp_dir, 'google_appengine_1.9.57.zip')
+
+        with zipfile.ZipFile(filename, 'w') as archive:
+            archive.writestr('google_appengine/a.py', 'a')
+
+        try:
+            with mock.patch('multiprocessing.pool.ThreadPool') as mock_pool:
+                pool = mock_pool.return_value
+                pool.map_async.return_value.get.side_effect = KeyboardInterrupt
+
+                with self.assertRaises(KeyboardInterrupt):
+                    sdk.extract_archive(filename, os.path.join(temp_dir, 'out'))
+
+        finally:
+            shutil.rmtree(temp_dir)
+
+        # Waiting with a timeout is what lets the interrupt through.
+        self.assertEqual(
+            pool.map_async.return_value.get.call_args_list,
+            [mock.call(sdk.EXTRACT_TIMEOUT)],
+        )
+        self.assertTrue(pool.terminate.called)
+        self.assertFalse(pool.close.called)
+
+    def test_extract_uses_one_thread_if_cpu_count_unknown(self):
+        temp_dir = tempfile.mkdtemp()
+        filename = os.path.join(temp_dir, 'google_appengine_1.9.57.zip')
+
+        with zipfile.ZipFile(filename, 'w') as archive:
+            archive.writestr('google_appengine/a.py', 'a')
+            archive.writestr('google_appengine/b.py', 'b')
+
+        target = os.path.join(temp_dir, 'out')
+
+        try:
+            with mock.patch('multiprocessing.cpu_count', side_effect=NotImplementedError):
+                with mock.patch('multiprocessing.pool.ThreadPool', wraps=sdk.multiprocessing.pool.ThreadPool) as mock_pool:
+                    sdk.extract_archive(filename, target)
+
+            extracted = sorted(os.listdir(os.path.join(target, 'google_appengine')))
+
+        finally:
+            shutil.rmtree(temp_dir)
+
+        self.assertEqual(mock_pool.call_args_list, [mock.call(1)])
+        self.assertEqual(extracted, ['a.py', 'b.py'])
+
+    def extract_script_with_mode(self, external_mode, create_system=3, umask=0o022):
+        """Extracts an archive with 1 script, returns the script's mode."""
+        temp_dir = tempfile.mkdtemp()
+        filename = os.path.join(temp_dir, 'google_appengine_1.9.57.zip')
+
+        with zipfile.ZipFile(filename, 'w') as archive:
+            info = zipfile.ZipInfo('google_appengine/dev_appserver.py')
+            info.create_system = create_system
+            info.external_attr = external_mode << 16
+            archive.writestr(info, 'foo')
+
+        config = configparser.ConfigParser(defaults={'cache_dir': temp_dir})
+        env = sdk.Env(config=config)
+        old_umask = os.umask(umask)
+
+        try:
+            target = env._extract(filename, '1.9.57')
+            script = os.path.join(target, 'google_appengine', 'dev_appserver.py')
+            mode = os.stat(script).st_mode & 0o7777
+
+        finally:
+            os.umask(old_umask)
+            shutil.rmtree(temp_dir)
+
+        return mode
+
+    def test_extract_ignores_script_permissions_in_archive(self):
+        # zipfile doesn't apply the archive's permissions, so neither do we.
+        for external_mode in [0o200, 0o600, 0o640, 0o666, 0o777, 0o4755]:
+            mode = self.extract_script_with_mode(external_mode)
+
+            self.assertEqual(mode, 0o755, oct(external_mode))
+
+    def test_extract_ignores_permissions_from_non_unix_archive(self):
+        mode = self.extract_script_with_mode(0o600, create_system=0)
+
+        self.assertEqual(mode, 0o755)
+
+    def test_extract_script_permissions_follow_umask(self):
+        mode = self.extract_script_with_mode(0o644, umask=0o077)
+
+        self.assertEqual(mode, 0o711)
 
 
 class RemoveCommandTestCase(unittest.TestCase):
@@ -358,13 +700,158 @@ class RemoveCommandTestCase(unittest.TestCase):
     def test_remove_deletes_installed_sdk(self):
         env = sdk.Env()
 
-        with mock.patch('shutil.rmtree') as mock_rmtree:
-            env.remove(version='1.9.57')
+        with mock.patch('os.listdir', return_value=[]):
+            with mock.patch('os.rename') as mock_rename:
+                with mock.patch('os.urandom', return_value='\x00\x01\x02\x03'):
+                    with mock.patch('shutil.rmtree') as mock_rmtree:
+                        env.remove(version='1.9.57')
+
+        deleting = '/home/foo/.sdkswitcher/1.9.57.deleting.00010203'
 
         self.assertEqual(
-            mock_rmtree.call_args_list,
-            [mock.call('/home/foo/.sdkswitcher/1.9.57')],
+            mock_rename.call_args_list,
+            [mock.call('/home/foo/.sdkswitcher/1.9.57', deleting)],
         )
+        self.assertEqual(mock_rmtree.call_args_list, [mock.call(deleting)])
+
+    def test_remove_deletes_sdk_directory(self):
+        temp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(temp_dir, '1.9.57', 'google_appengine'))
+
+        config = configparser.ConfigParser(defaults={'cache_dir': temp_dir})
+        env = sdk.Env(config=config)
+
+        try:
+            env._remove('1.9.57')
+            remaining = os.listdir(temp_dir)
+
+        finally:
+            shutil.rmtree(temp_dir)
+
+        self.assertEqual(remaining, [])
+
+    def test_remove_deletes_leftovers_from_earlier_remove(self):
+        temp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(temp_dir, '1.9.56.deleting.00010203', 'google_appengine'))
+        os.makedirs(os.path.join(temp_dir, '1.9.57', 'google_appengine'))
+        os.makedirs(os.path.join(temp_dir, '1.9.58', 'google_appengine'))
+        # Things that aren't leftovers from _remove are left alone.
+        os.makedirs(os.path.join(temp_dir, 'photos.deleting.later'))
+        open(os.path.join(temp_dir, '1.9.55.deleting.00010203'), 'w').close()
+
+        config = configparser.ConfigParser(defaults={'cache_dir': temp_dir})
+        env = sdk.Env(config=config)
+
+        try:
+            env._remove('1.9.57')
+            remaining = sorted(os.listdir(temp_dir))
+
+        finally:
+            shutil.rmtree(temp_dir)
+
+        self.assertEqual(remaining, ['1.9.55.deleting.00010203', '1.9.58', 'photos.deleting.later'])
+
+    def test_remove_error_is_raised(self):
+        temp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(temp_dir, '1.9.57', 'google_appengine'))
+
+        config = configparser.ConfigParser(defaults={'cache_dir': temp_dir})
+        env = sdk.Env(config=config)
+        not_permitted = OSError(errno.EPERM, 'Operation not permitted')
+
+        try:
+            with mock.patch('shutil.rmtree', side_effect=not_permitted):
+                with self.assertRaises(OSError):
+                    env.remove(version='1.9.57')
+
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+@mock.patch('urllib.getproxies', return_value={})
+@mock.patch.dict('sdk._connections', clear=True)
+class UrlopenTestCase(unittest.TestCase):
+    def test_reuses_connection_for_same_host(self, mock_getproxies):
+        conn = mock.Mock()
+        conn.getresponse.return_value.status = 200
+
+        with mock.patch('httplib.HTTPSConnection', return_value=conn) as mock_conn:
+            sdk.urlopen('https://example.com/foo.zip')
+            sdk.urlopen('https://example.com/bar/baz.zip?q=1')
+
+        self.assertEqual(mock_conn.call_args_list, [mock.call('example.com')])
+        self.assertEqual(
+            conn.request.call_args_list,
+            [mock.call('GET', '/foo.zip'), mock.call('GET', '/bar/baz.zip?q=1')],
+        )
+
+    def test_raises_http_error_for_404(self, mock_getproxies):
+        conn = mock.Mock()
+        conn.getresponse.return_value.status = 404
+
+        with mock.patch('httplib.HTTPSConnection', return_value=conn):
+            with self.assertRaises(urllib2.HTTPError):
+                sdk.urlopen('https://example.com/foo.zip')
+
+    def test_retries_on_closed_connection(self, mock_getproxies):
+        conn = mock.Mock()
+        response = mock.Mock(status=200)
+        conn.getresponse.side_effect = [httplib.BadStatusLine(''), response]
+
+        with mock.patch('httplib.HTTPSConnection', return_value=conn):
+            result = sdk.urlopen('https://example.com/foo.zip')
+
+        self.assertIs(result, response)
+        self.assertTrue(conn.close.called)
+        self.assertEqual(conn.request.call_count, 2)
+
+    def test_raises_url_error_if_retry_fails(self, mock_getproxies):
+        conn = mock.Mock()
+        refused = socket.error(errno.ECONNREFUSED, 'Connection refused')
+        conn.request.side_effect = [httplib.BadStatusLine(''), refused]
+
+        with mock.patch('httplib.HTTPSConnection', return_value=conn):
+            with self.assertRaises(urllib2.URLError):
+                sdk.urlopen('https://example.com/foo.zip')
+
+    def test_follows_redirects(self, mock_getproxies):
+        conn = mock.Mock()
+        redirect = mock.Mock(status=302)
+        redirect.getheader.return_value = '/bar.zip'
+        response = mock.Mock(status=200)
+        conn.getresponse.side_effect = [redirect, response]
+
+        with mock.patch('httplib.HTTPSConnection', return_value=conn):
+            result = sdk.urlopen('https://example.com/foo.zip', method='HEAD')
+
+        self.assertIs(result, response)
+        self.assertEqual(
+            conn.request.call_args_list,
+            [mock.call('HEAD', '/foo.zip'), mock.call('HEAD', '/bar.zip')],
+        )
+
+    def test_uses_urllib2_with_a_proxy(self, mock_getproxies):
+        mock_getproxies.return_value = {'https': 'http://proxy.example.com:3128'}
+
+        with mock.patch('urllib.proxy_bypass', return_value=False):
+            with mock.patch('urllib2.urlopen') as mock_urlopen:
+                with mock.patch('httplib.HTTPSConnection') as mock_conn:
+                    result = sdk.urlopen('https://example.com/foo.zip', method='HEAD')
+
+        request = mock_urlopen.call_args[0][0]
+
+        self.assertIs(result, mock_urlopen.return_value)
+        self.assertEqual(request.get_full_url(), 'https://example.com/foo.zip')
+        self.assertEqual(request.get_method(), 'HEAD')
+        self.assertFalse(mock_conn.called)
+
+
+class VersionKeyTestCase(unittest.TestCase):
+    def test_sorts_numerically(self):
+        versions = ['1.9.40', '1.10.0', '1.9.5']
+        result = sorted(versions, key=sdk.version_key)
+
+        self.assertEqual(result, ['1.9.5', '1.9.40', '1.10.0'])
 
 
 class SafeFilenameTestCase(unittest.TestCase):
@@ -380,6 +867,12 @@ class SafeFilenameTestCase(unittest.TestCase):
 
         self.assertEqual(result, 'bar.zip')
 
+    def test_safe_unsafe_characters_next_to_dots(self):
+        value = 'foo/bar .?.zip'
+        result = sdk.safe_filename(value)
+
+        self.assertEqual(result, 'bar.zip')
+
     def test_safe_3(self):
         value = '..'
 